@@ -2,18 +2,45 @@ import logging
 import configparser
 from bluepy import btle
 import time
-from datetime import datetime
 from medisana import MedisanaBS440
 import struct
 import importlib
+import importlib.util
 import os
 import sys
+import queue
+import threading
+from collections import Counter
+
+# GATT characteristic property bit for indications
+INDICATE_PROPERTY = 0x20
+
+# Medisana weight service and its command (write) characteristic
+WEIGHT_SERVICE_UUID = btle.UUID("000078b2-0000-1000-8000-00805f9b34fb")
+WRITE_CHAR_UUID = btle.UUID("00008a81-0000-1000-8000-00805f9b34fb")
+
+# Poll interval while collecting, and the quiet period after the last measurement that ends collection
+NOTIFICATION_POLL_INTERVAL = 0.25
+IDLE_TIMEOUT = 2
+
+# Time sync command: 0x02 followed by the scale time as little endian uint32
+TIME_SYNC_STRUCT = struct.Struct('<BI')
+
+# Seconds to wait for queued plugin batches on shutdown
+PLUGIN_DRAIN_TIMEOUT = 10
 
 def setup_logging():
+    # The log format only uses time, level and message, so skip collecting
+    # caller, thread and process information for every record
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
+        datefmt='%Y-%m-%d %H:%M:%S',
+        force=True
     )
     return logging.getLogger(__name__)
 
@@ -29,6 +56,9 @@ def read_config():
     log_level = getattr(logging, config['Logging']['level'].upper())
     return config, mac_addresses, log_level
 
+# Plugin classes already imported, keyed by plugin name
+_PLUGIN_CACHE = {}
+
 def load_plugins(config, logger):
     """Load all enabled plugins."""
     plugins = []
@@ -46,10 +76,16 @@ def load_plugins(config, logger):
     for plugin_name in plugin_names:
         try:
             logger.info(f"Attempting to load plugin: {plugin_name}")
-            module_name = f"plugins.{plugin_name.lower()}"
-            logger.debug(f"Importing module: {module_name}")
-            module = importlib.import_module(module_name)
-            plugin_class = getattr(module, plugin_name)
+            plugin_class = _PLUGIN_CACHE.get(plugin_name)
+            if plugin_class is None:
+                module_name = f"plugins.{plugin_name.lower()}"
+                if importlib.util.find_spec(module_name) is None:
+                    logger.error(f"Failed to load plugin {plugin_name}: module {module_name} not found")
+                    continue
+                logger.debug(f"Importing module: {module_name}")
+                module = importlib.import_module(module_name)
+                plugin_class = getattr(module, plugin_name)
+                _PLUGIN_CACHE[plugin_name] = plugin_class
             logger.debug(f"Instantiating plugin class: {plugin_name}")
             plugin = plugin_class(config, logger)
             plugins.append(plugin)
@@ -62,54 +98,121 @@ def load_plugins(config, logger):
 class BLEScanner(btle.DefaultDelegate):
     def __init__(self, target_macs, logger):
         btle.DefaultDelegate.__init__(self)
-        self.target_macs = [mac.lower() for mac in target_macs]
+        self.target_macs = frozenset(mac.lower() for mac in target_macs)
         self.logger = logger
         self.scanner = btle.Scanner()
         self.medisana = MedisanaBS440(logger)
         self.plugins = []
         self.measurements = []  # Store measurements for processing
+        self.measurement_types = Counter()  # Measurement count per type for this session
+        self._processed_once = False  # Set once the session's measurements went to the plugins
+        self._char_cache = {}  # {device_addr: (write_handle, [cccd_handle, ...])}
+        
+        # Plugins run on a worker thread so the BLE session can disconnect right away
+        self._plugin_q = queue.Queue()
+        self._plugin_thread = threading.Thread(target=self._plugin_worker, name="plugin-worker", daemon=True)
+        self._plugin_thread.start()
+    
+    def _plugin_worker(self):
+        """Run queued measurement batches through the plugins."""
+        while True:
+            item = self._plugin_q.get()
+            if item is None:
+                self._plugin_q.task_done()
+                break
+            plugins, measurements = item
+            try:
+                for plugin in plugins:
+                    try:
+                        self.logger.info(f"Batch processing measurements with plugin: {plugin.name}")
+                        plugin.process_measurements(measurements)
+                        self.logger.info(f"Successfully batch processed measurements with plugin: {plugin.name}")
+                    except Exception as e:
+                        self.logger.error(f"Error in plugin {plugin.name} during batch processing: {str(e)}", exc_info=True)
+            finally:
+                self._plugin_q.task_done()
+    
+    def stop(self, timeout=PLUGIN_DRAIN_TIMEOUT):
+        """Let the plugin worker finish queued batches, waiting at most timeout seconds."""
+        self._plugin_q.put(None)
+        self._plugin_thread.join(timeout)
+        if self._plugin_thread.is_alive():
+            self.logger.warning("Plugin worker did not finish before shutdown, pending measurements may be lost")
     
     def _process_collected_measurements(self):
         """Process all collected measurements with plugins."""
+        if self._processed_once:
+            self.logger.debug("Measurements for this session were already processed, skipping")
+            return
+        
         self.logger.info(f"Collection complete. Total measurements received: {len(self.measurements)}")
         if self.measurements:
-            measurement_types = {}
-            for m in self.measurements:
-                mtype = m.get('type', 'unknown')
-                measurement_types[mtype] = measurement_types.get(mtype, 0) + 1
-            self.logger.info(f"Measurement breakdown: {measurement_types}")
+            self.logger.info(f"Measurement breakdown: {dict(self.measurement_types)}")
         
         # Process all collected measurements with plugins (batch processing)
         # Note: We pass measurements in the order received, not sorted by timestamp,
         # because timestamps from the scale can be corrupted. The last measurement
         # received is the most recent.
         if self.plugins and self.measurements:
-            self.logger.info(f"Processing {len(self.measurements)} measurements with {len(self.plugins)} plugin(s)")
-            
-            for plugin in self.plugins:
-                try:
-                    self.logger.info(f"Batch processing measurements with plugin: {plugin.name}")
-                    plugin.process_measurements(self.measurements)
-                    self.logger.info(f"Successfully batch processed measurements with plugin: {plugin.name}")
-                except Exception as e:
-                    self.logger.error(f"Error in plugin {plugin.name} during batch processing: {str(e)}", exc_info=True)
+            self.logger.info(f"Queueing {len(self.measurements)} measurements for {len(self.plugins)} plugin(s)")
+            self._plugin_q.put((list(self.plugins), self.measurements))
         elif self.plugins:
             self.logger.warning(f"Plugins loaded ({len(self.plugins)}) but no measurements to process")
         elif not self.plugins:
             self.logger.warning("No plugins loaded - measurements will not be processed")
+        
+        # Make sure a retry of the same session cannot hand these to the plugins again
+        self._processed_once = True
+        self.measurements = []
+        self.measurement_types.clear()
     
     def handleNotification(self, handle, data):
         """Handle incoming notifications from the scale"""
-        self.logger.debug(f"Received notification on handle {handle}: {data.hex()}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Received notification on handle %d: %s", handle, data.hex())
         measurement = self.medisana.parse_measurement(data)
         if measurement:
-            self.logger.info(f"Processed measurement: {measurement}")
+            self.logger.info("Processed measurement: %s", measurement)
             # Store measurement for later processing
             self.measurements.append(measurement)
-            self.logger.debug(f"Stored measurement (total: {len(self.measurements)})")
+            self.measurement_types[measurement.get('type', 'unknown')] += 1
+            self.logger.debug("Stored measurement (total: %d)", len(self.measurements))
         else:
             self.logger.debug("Measurement parsing returned None, skipping")
 
+    def _enable_indications(self, peripheral, cccd_handles):
+        """Write 0x0200 to each CCCD to enable indications"""
+        # Descriptor writes must be acknowledged Write Requests, some servers ignore Write Commands
+        for cccd in cccd_handles:
+            self.logger.debug("Enabling notifications on handle %d", cccd)
+            peripheral.writeCharacteristic(cccd, b"\x02\x00", withResponse=True)
+
+    def _discover_characteristics(self, peripheral):
+        """Discover the weight service and return (write_handle, [cccd_handle, ...]) or None"""
+        self.logger.debug("Discovering weight measurement service...")
+        try:
+            service = peripheral.getServiceByUUID(WEIGHT_SERVICE_UUID)
+        except btle.BTLEGattError:
+            self.logger.warning("Weight measurement service not found on device")
+            return None
+        
+        self.logger.info("Found weight measurement service!")
+        write_char = None
+        cccd_handles = []
+        
+        # Single pass: collect INDICATE CCCD handles and find the write characteristic
+        for char in service.getCharacteristics():
+            if char.properties & INDICATE_PROPERTY:
+                self.logger.debug(f"Found INDICATE characteristic {char.uuid}")
+                cccd_handles.append(char.getHandle() + 1)
+            if write_char is None and char.uuid == WRITE_CHAR_UUID:
+                write_char = char
+        
+        if write_char:
+            return write_char.getHandle(), cccd_handles
+        
+        return None
+
     def connect_to_device(self, device_addr):
         """Returns True if connection and data exchange was successful"""
         max_retries = 3
@@ -122,71 +225,82 @@ class BLEScanner(btle.DefaultDelegate):
                 self.logger.info("Successfully connected!")
                 
                 try:
-                    self.logger.debug("Discovering services...")
-                    services = peripheral.services
-                    if not services:
-                        self.logger.debug("No services found, attempting discovery...")
-                        services = peripheral.discoverServices()
-                    
-                    weight_service_uuid = "000078b2-0000-1000-8000-00805f9b34fb"
-                    write_char_uuid = "00008a81-0000-1000-8000-00805f9b34fb"
+                    device_key = device_addr.lower()
+                    handles = self._char_cache.get(device_key)
+                    from_cache = handles is not None
+                    if from_cache:
+                        self.logger.debug("Using cached characteristic handles, skipping service discovery")
+                    else:
+                        handles = self._discover_characteristics(peripheral)
+                        if handles:
+                            self._char_cache[device_key] = handles
                     
-                    for service in services:
-                        if str(service.uuid).lower() == weight_service_uuid:
-                            self.logger.info("Found weight measurement service!")
-                            write_char = None
-                            
+                    if handles:
+                        write_handle, cccd_handles = handles
+                        # Clear measurements list for this connection session before enabling
+                        # indications, so nothing delivered during setup is thrown away
+                        self.measurements = []
+                        self.measurement_types.clear()
+                        self._processed_once = False
+                        try:
                             # Enable notifications for all INDICATE characteristics
-                            for char in service.getCharacteristics():
-                                if char.propertiesToString().find('INDICATE') >= 0:
-                                    self.logger.debug(f"Enabling notifications for {char.uuid}")
-                                    peripheral.writeCharacteristic(char.getHandle() + 1, b"\x02\x00", withResponse=True)
-                            
-                            # Find the write characteristic for commands
-                            for char in service.getCharacteristics():
-                                if str(char.uuid).lower() == write_char_uuid:
-                                    write_char = char
-                                    break
+                            self._enable_indications(peripheral, cccd_handles)
                             
-                            if write_char:
-                                self.logger.debug("Sending initialization commands...")
-                                write_char.write(b"\x01", withResponse=True)  # Start measurement mode
-                                
-                                # Send time synchronization command
-                                # The time_offset should be 1262304000 for BS410/BS444 models (Jan 1, 2010)
-                                time_offset = 1262304000
-                                if self.send_time_sync_command(peripheral, write_char.getHandle(), time_offset):
-                                    self.logger.info("Scale time synchronized")
-                                else:
-                                    self.logger.warning("Failed to synchronize scale time")
-                                
-                                # Wait for notifications
-                                self.logger.info("Waiting for measurements...")
-                                self.logger.info("Please step on the scale now...")
-                                
-                                timeout = 30  # Seconds
-                                self.logger.info(f"Waiting for {timeout} seconds to receive all stored measurements...")
-                                # Clear measurements list for this connection session
-                                self.measurements = []
-                                start_time = time.time()
+                            self.logger.debug("Sending initialization commands...")
+                            peripheral.writeCharacteristic(write_handle, b"\x01", withResponse=True)  # Start measurement mode
+                        except btle.BTLEException:
+                            if from_cache:
+                                # Cached handles may be stale (e.g. invalid handle), rediscover on the next attempt
+                                self.logger.debug("Invalidating cached characteristic handles")
+                                self._char_cache.pop(device_key, None)
+                            raise
+                        
+                        # Send time synchronization command
+                        # The time_offset should be 1262304000 for BS410/BS444 models (Jan 1, 2010)
+                        time_offset = 1262304000
+                        if self.send_time_sync_command(peripheral, write_handle, time_offset):
+                            self.logger.info("Scale time synchronized")
+                        else:
+                            self.logger.warning("Failed to synchronize scale time")
+                        
+                        # Wait for notifications
+                        self.logger.info("Waiting for measurements...")
+                        self.logger.info("Please step on the scale now...")
+                        
+                        timeout = 30  # Seconds
+                        self.logger.info(f"Waiting up to {timeout} seconds to receive all stored measurements...")
+                        start_time = time.time()
+                        last_activity = start_time
+                        last_count = 0
+                        try:
+                            while time.time() - start_time < timeout:
                                 try:
-                                    while time.time() - start_time < timeout:
-                                        try:
-                                            if peripheral.waitForNotifications(1.0):
-                                                # Notifications received, continue waiting
-                                                continue
-                                            # No notifications received for 1 second, but keep waiting until timeout
-                                        except btle.BTLEDisconnectError:
-                                            self.logger.warning("Device disconnected during measurement collection, processing collected measurements")
-                                            break
-                                        except Exception as e:
-                                            self.logger.warning(f"Error waiting for notifications: {str(e)}, processing collected measurements")
-                                            break
+                                    peripheral.waitForNotifications(NOTIFICATION_POLL_INTERVAL)
+                                    now = time.time()
+                                    if len(self.measurements) > last_count:
+                                        # New measurements received, keep waiting for the rest of the burst
+                                        last_count = len(self.measurements)
+                                        last_activity = now
+                                    elif last_count and now - last_activity >= IDLE_TIMEOUT:
+                                        # The scale sends its measurements in one burst, stop once it has gone quiet
+                                        self.logger.info(f"No new measurements for {IDLE_TIMEOUT} seconds, finishing collection")
+                                        break
+                                except btle.BTLEDisconnectError:
+                                    self.logger.warning("Device disconnected during measurement collection, processing collected measurements")
+                                    break
                                 except Exception as e:
-                                    self.logger.warning(f"Exception during measurement collection: {str(e)}, processing collected measurements")
-                                
-                                # After receiving all measurements, log summary and process batch if needed
-                                self._process_collected_measurements()
+                                    self.logger.warning(f"Error waiting for notifications: {str(e)}, processing collected measurements")
+                                    break
+                        except Exception as e:
+                            self.logger.warning(f"Exception during measurement collection: {str(e)}, processing collected measurements")
+                        
+                        if from_cache and not self.measurements:
+                            # Stale CCCD handles fail silently, rediscover on the next connection
+                            self.logger.debug("No measurements with cached characteristic handles, invalidating cache")
+                            self._char_cache.pop(device_key, None)
+                        
+                        # After receiving all measurements, log summary and process batch if needed
+                        self._process_collected_measurements()
 
                 finally:
                     try:
@@ -201,7 +315,7 @@ class BLEScanner(btle.DefaultDelegate):
             except btle.BTLEDisconnectError as e:
                 self.logger.warning(f"Device disconnected during attempt {attempt + 1}: {str(e)}")
                 # Process any measurements collected before disconnect
-                if self.measurements:
+                if self.measurements and not self._processed_once:
                     self._process_collected_measurements()
                 time.sleep(1)  # Wait before retry
             except btle.BTLEException as e:
@@ -217,24 +331,26 @@ class BLEScanner(btle.DefaultDelegate):
         try:
             while True:  # Keep scanning until we successfully connect
                 self.logger.info("Starting BLE scan...")
-                devices = self.scanner.scan(timeout=3.0)  # Shorter scan intervals
+                # Passive scan: the scale's address is in its advertisements, no scan responses needed
+                devices = self.scanner.scan(timeout=2.0, passive=True)
                 
-                for dev in devices:
-                    device_mac = dev.addr.lower()
-                    
-                    if device_mac in self.target_macs:
-                        self.logger.info(f"Found target device: {dev.addr}")
-                        self.logger.info(f"  RSSI: {dev.rssi} dB")
-                        self.logger.info(f"  Address type: {dev.addrType}")
+                # Filter on address first, bluepy reports addresses in lowercase already
+                target_devs = [dev for dev in devices if dev.addr in self.target_macs]
+                self.logger.debug("Ignored %d non-target device(s)", len(devices) - len(target_devs))
+                
+                for dev in target_devs:
+                    # Advertisement data is only decoded for target devices
+                    if self.logger.isEnabledFor(logging.INFO):
+                        self.logger.info("Found target device: %s", dev.addr)
+                        self.logger.info("  RSSI: %s dB", dev.rssi)
+                        self.logger.info("  Address type: %s", dev.addrType)
                         
                         for (adtype, desc, value) in dev.getScanData():
-                            self.logger.info(f"  {desc}: {value}")
-                        
-                        # Attempt to connect immediately when we find our target device
-                        if self.connect_to_device(dev.addr):
-                            return True  # Successfully connected and completed
-                    else:
-                        self.logger.debug(f"Ignored device: {dev.addr}")
+                            self.logger.info("  %s: %s", desc, value)
+                    
+                    # Attempt to connect immediately when we find our target device
+                    if self.connect_to_device(dev.addr):
+                        return True  # Successfully connected and completed
                 
                 # Short sleep before next scan attempt
                 time.sleep(1)
@@ -254,15 +370,14 @@ class BLEScanner(btle.DefaultDelegate):
         The scale expects the Unix timestamp in little endian order preceded by 0x02.
         """
         try:
-            # Create timestamp bytearray in the format the scale expects
-            # Current time minus the offset (to convert to scale's time base)
-            timestamp = bytearray(struct.pack('<I', int(time.time() - time_offset)))
-            timestamp.insert(0, 2)  # Prepend with 0x02 as required by the protocol
+            # 0x02 command byte followed by the current time minus the offset
+            # (to convert to scale's time base)
+            payload = TIME_SYNC_STRUCT.pack(2, int(time.time() - time_offset))
             
-            self.logger.debug(f"Sending time sync command: {timestamp.hex()}")
+            self.logger.debug(f"Sending time sync command: {payload.hex()}")
             
             # Write to the command characteristic
-            device.writeCharacteristic(command_characteristic, timestamp, withResponse=True)
+            device.writeCharacteristic(command_characteristic, payload, withResponse=True)
             self.logger.info("Time synchronization command sent to scale")
             return True
         except Exception as e:
@@ -271,6 +386,7 @@ class BLEScanner(btle.DefaultDelegate):
 
 def main():
     logger = setup_logging()
+    scanner = None
     
     try:
         config, target_macs, log_level = read_config()
@@ -298,6 +414,9 @@ def main():
     except Exception as e:
         logger.error(f"Fatal error: {str(e)}")
         raise
+    finally:
+        if scanner is not None:
+            scanner.stop()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
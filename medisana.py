@@ -1,6 +1,32 @@
 from datetime import datetime, timedelta
+import logging
 import struct
-import sys
+
+# Little endian field layouts used in the scale's messages
+_U_H = struct.Struct('<H')
+_U_I = struct.Struct('<I')
+_U_5H = struct.Struct('<HHHHH')
+
+# Scale time 0 is 2010-01-01 (Unix timestamp 1262304000)
+TIME_OFFSET = 1262304000
+
+def _max_timestamp():
+    """Largest scale timestamp (as Unix time) that datetime.fromtimestamp accepts on this platform"""
+    # Scale timestamps top out at 0x7FFFFFFF past TIME_OFFSET (2078), a 32-bit time_t
+    # (e.g. Raspberry Pi OS) overflows past 2038
+    for bound in (0x7FFFFFFF + TIME_OFFSET, 2**31 - 1):
+        try:
+            datetime.fromtimestamp(bound)
+            return bound
+        except (ValueError, OSError, OverflowError):
+            pass
+    return -1
+
+# Largest Unix timestamp converted to datetime, anything later is treated as invalid
+MAX_TIMESTAMP = _max_timestamp()
+
+# Weight status bits 0-1 -> (stabilized, impedance_measured)
+_WEIGHT_FLAGS = ((False, False), (True, False), (False, True), (True, True))
 
 class MedisanaBS440:
     def __init__(self, logger):
@@ -8,150 +34,103 @@ class MedisanaBS440:
         
     def parse_measurement(self, data):
         """Parse measurement data from BS440 scale"""
-        measurement = {}
-        
-        # Convert bytes to hex string for logging
-        hex_data = data.hex()
-        self.logger.debug(f"Parsing measurement data: {hex_data}")
+        # Only convert bytes to a hex string when it will actually be logged
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Parsing measurement data: {data.hex()}")
         
         try:
             message_type = data[0]
-            
-            if message_type == 0x84:  # Person data
-                # Format: BxBxBBBxB
-                # B = type (0x84), x = pad, B = person, x = pad, B = gender, B = age, B = size, x = pad, B = activity
-                measurement['type'] = 'person'
-                # First byte should be 0x84 for validity
-                if data[0] != 0x84:
-                    return None
-                measurement['person'] = data[2]
-                measurement['gender'] = 'male' if data[4] == 1 else 'female'
-                measurement['age'] = data[5]
-                measurement['size'] = data[6]  # Height in cm
-                measurement['activity'] = 'high' if data[8] == 3 else 'normal'
-                
-            elif message_type == 0x1D:  # Weight data
-                # Format: BHxxIxxxxB
-                # B = type (0x1D), H = weight (LSB), xx = pad, 
-                # I = timestamp, xxxx = pad, B = person
-                measurement['type'] = 'weight'
-                
-                # First byte should be 0x1D for validity
-                if data[0] != 0x1D:
-                    return None
-                
-                # Weight is 2 bytes, little endian, in 10g units
-                weight = struct.unpack('<H', data[1:3])[0]
-                weight_kg = weight / 100.0  # Convert to kg
-                measurement['weight'] = weight_kg
-                
-                # Stability (bit 0), impedance measured (bit 1)
-                measurement['stabilized'] = bool(data[3] & 0x01)  
-                measurement['impedance_measured'] = bool(data[3] & 0x02)
-                
-                # Get raw timestamp from data
-                raw_timestamp = struct.unpack('<I', data[5:9])[0]
-                
-                # Log raw timestamp and hex representation for debugging
-                self.logger.debug(f"Weight raw timestamp: {raw_timestamp} (0x{raw_timestamp:08x})")
-                
-                # Apply time offset from original BS440.py code
-                # On BS410/BS444 time=0 equals 1/1/2010 (timestamp 1262304000)
-                time_offset = 1262304000  # 2010-01-01 in Unix timestamp
-                
-                # Apply sanitization logic from original code
-                if raw_timestamp + time_offset < sys.maxsize:
-                    unix_timestamp = raw_timestamp + time_offset
-                    self.logger.debug(f"Using timestamp with offset: {unix_timestamp}")
-                else:
-                    unix_timestamp = raw_timestamp
-                    self.logger.debug(f"Using raw timestamp: {unix_timestamp}")
-                
-                # If timestamp is still too large, use 0
-                if raw_timestamp >= sys.maxsize:
-                    unix_timestamp = 0
-                    self.logger.debug("Timestamp too large, using 0")
-                
-                # Convert to datetime
-                try:
-                    measurement['timestamp'] = datetime.fromtimestamp(unix_timestamp)
-                    self.logger.debug(f"Final timestamp: {measurement['timestamp']}")
-                except (ValueError, OSError, OverflowError) as e:
-                    self.logger.error(f"Error converting timestamp: {e}")
-                    # Fallback to current time
-                    measurement['timestamp'] = datetime.now()
-                    self.logger.debug(f"Using current time instead: {measurement['timestamp']}")
-                
-                measurement['person'] = data[13]  # Person ID at offset 13 as in original
-                
-            elif message_type == 0x6F:  # Body composition data
-                # Format: BIBHHHHH
-                # B = type (0x6F), I = timestamp, B = person, H = kcal, H = fat%, H = water%, H = muscle%, H = bone%
-                measurement['type'] = 'body'
-                
-                # First byte should be 0x6F for validity
-                if data[0] != 0x6F:
-                    return None
-                
-                # Get raw timestamp from data
-                raw_timestamp = struct.unpack('<I', data[1:5])[0]
-                
-                # Log raw timestamp and hex representation for debugging
-                self.logger.debug(f"Body raw timestamp: {raw_timestamp} (0x{raw_timestamp:08x})")
-                
-                # Apply sanitize_timestamp logic from original BS440.py
-                time_offset = 1262304000  # 2010-01-01 in Unix timestamp
-                max_timestamp = sys.maxsize
-                
-                # Detailed logging of timestamp processing
-                self.logger.debug(f"Time offset: {time_offset}")
-                self.logger.debug(f"Max timestamp: {max_timestamp}")
-                self.logger.debug(f"Raw + offset: {raw_timestamp + time_offset}")
-                
-                # Apply sanitization logic from original code
-                if raw_timestamp + time_offset < max_timestamp:
-                    unix_timestamp = raw_timestamp + time_offset
-                    self.logger.debug(f"Using sanitized timestamp: {unix_timestamp}")
-                else:
-                    unix_timestamp = raw_timestamp
-                    self.logger.debug(f"Using raw timestamp: {unix_timestamp}")
-                    
-                # If timestamp is still too large, use 0
-                if raw_timestamp >= max_timestamp:
-                    unix_timestamp = 0
-                    self.logger.debug("Timestamp too large, using 0")
-                
-                # Convert to datetime
-                try:
-                    measurement['timestamp'] = datetime.fromtimestamp(unix_timestamp)
-                    self.logger.debug(f"Final timestamp: {measurement['timestamp']}")
-                except (ValueError, OSError, OverflowError) as e:
-                    self.logger.error(f"Error converting timestamp: {e}")
-                    # Fallback to current time
-                    measurement['timestamp'] = datetime.now()
-                    self.logger.debug(f"Using current time instead: {measurement['timestamp']}")
-                
-                measurement['person'] = data[5]
-                
-                # Unpack all measurements at once
-                kcal, fat, water, muscle, bone = struct.unpack('<HHHHH', data[6:16])
-                
-                measurement['kcal'] = kcal
-                # Fat, water, muscle and bone need to mask first nibble (0xf) and divide by 10
-                measurement['fat'] = (0x0FFF & fat) / 10.0
-                measurement['tbw'] = (0x0FFF & water) / 10.0  # Total Body Water
-                measurement['muscle'] = (0x0FFF & muscle) / 10.0
-                measurement['bone'] = (0x0FFF & bone) / 10.0
-                
-            else:
-                self.logger.debug(f"Unknown message type: 0x{message_type:02x}")
+            parser = _PARSERS[message_type]
+            if parser is None:
+                self.logger.debug("Unknown message type: 0x%02x", message_type)
                 return None
-                
-            return measurement
+            
+            return parser(self, data)
             
         except Exception as e:
             self.logger.error(f"Error parsing measurement data: {str(e)}")
             return None
+    
+    @staticmethod
+    def _sanitize_ts(raw_timestamp):
+        """Convert a raw scale timestamp to a Unix timestamp, None if it is corrupt"""
+        # On BS410/BS444 time=0 equals 1/1/2010, values with the top bit set are corrupt
+        return raw_timestamp + TIME_OFFSET if raw_timestamp < 0x80000000 else None
+    
+    def _to_datetime(self, unix_timestamp):
+        """Convert a Unix timestamp to datetime, falling back to the current time"""
+        if unix_timestamp is not None and 0 <= unix_timestamp <= MAX_TIMESTAMP:
+            timestamp = datetime.fromtimestamp(unix_timestamp)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Final timestamp: {timestamp}")
+        else:
+            self.logger.error(f"Timestamp out of range: {unix_timestamp}")
+            # Fallback to current time
+            timestamp = datetime.now()
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Using current time instead: {timestamp}")
+        return timestamp
+    
+    def _parse_person(self, data):
+        """Parse person data (message type 0x84)"""
+        # Format: BxBxBBBxB
+        # B = type (0x84), x = pad, B = person, x = pad, B = gender, B = age, B = size, x = pad, B = activity
+        measurement = {'type': 'person'}
+        measurement['person'] = data[2]
+        measurement['gender'] = 'male' if data[4] == 1 else 'female'
+        measurement['age'] = data[5]
+        measurement['size'] = data[6]  # Height in cm
+        measurement['activity'] = 'high' if data[8] == 3 else 'normal'
+        return measurement
+    
+    def _parse_weight(self, data):
+        """Parse weight data (message type 0x1D)"""
+        # Format: BHxxIxxxxB
+        # B = type (0x1D), H = weight (LSB), xx = pad, 
+        # I = timestamp, xxxx = pad, B = person
+        measurement = {'type': 'weight'}
+        
+        # Weight is 2 bytes, little endian, in 10g units
+        weight = _U_H.unpack_from(data, 1)[0]
+        weight_kg = weight / 100.0  # Convert to kg
+        measurement['weight'] = weight_kg
+        
+        # Stability (bit 0), impedance measured (bit 1)
+        measurement['stabilized'], measurement['impedance_measured'] = _WEIGHT_FLAGS[data[3] & 0x03]
+        
+        # Get raw timestamp from data
+        raw_timestamp = _U_I.unpack_from(data, 5)[0]
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Weight raw timestamp: {raw_timestamp} (0x{raw_timestamp:08x})")
+        measurement['timestamp'] = self._to_datetime(self._sanitize_ts(raw_timestamp))
+        
+        measurement['person'] = data[13]  # Person ID at offset 13 as in original
+        return measurement
+    
+    def _parse_body(self, data):
+        """Parse body composition data (message type 0x6F)"""
+        # Format: BIBHHHHH
+        # B = type (0x6F), I = timestamp, B = person, H = kcal, H = fat%, H = water%, H = muscle%, H = bone%
+        measurement = {'type': 'body'}
+        
+        # Get raw timestamp from data
+        raw_timestamp = _U_I.unpack_from(data, 1)[0]
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Body raw timestamp: {raw_timestamp} (0x{raw_timestamp:08x})")
+        measurement['timestamp'] = self._to_datetime(self._sanitize_ts(raw_timestamp))
+        
+        measurement['person'] = data[5]
+        
+        # Unpack all measurements at once
+        kcal, fat, water, muscle, bone = _U_5H.unpack_from(data, 6)
+        
+        measurement['kcal'] = kcal
+        # Fat, water, muscle and bone need to mask first nibble (0xf) and divide by 10
+        measurement['fat'] = (0x0FFF & fat) / 10.0
+        measurement['tbw'] = (0x0FFF & water) / 10.0  # Total Body Water
+        measurement['muscle'] = (0x0FFF & muscle) / 10.0
+        measurement['bone'] = (0x0FFF & bone) / 10.0
+        return measurement
             
     def _parse_timestamp(self, data):
         """Parse timestamp from BS440 data"""
@@ -193,3 +172,9 @@ class MedisanaBS440:
         except Exception as e:
             self.logger.error(f"Error parsing timestamp: {str(e)}")
             return None
+
+# Parser method indexed by message type (first byte), None for unknown types
+_PARSERS = [None] * 256
+_PARSERS[0x84] = MedisanaBS440._parse_person
+_PARSERS[0x1D] = MedisanaBS440._parse_weight
+_PARSERS[0x6F] = MedisanaBS440._parse_body
@@ -1,9 +1,62 @@
 import paho.mqtt.client as mqtt
+import functools
 import json
-import time
+import logging
 from datetime import datetime
 from plugins.plugin_base import PluginBase
 
+try:
+    import orjson  # Optional, faster serializer with native datetime support
+except ImportError:
+    orjson = None
+
+class _DateTimeEncoder(json.JSONEncoder):
+    """JSON encoder that writes datetime values (measurement timestamps) in ISO format."""
+    
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+def _dumps(data):
+    """Serialize data to compact JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    # json.dumps escapes non-ASCII characters, so the result is always ASCII
+    return json.dumps(data, cls=_DateTimeEncoder, separators=(',', ':')).encode('ascii')
+
+@functools.lru_cache(maxsize=64)
+def _topic_for(prefix, person_id, measurement_type):
+    """Return the MQTT topic for a person's measurement type."""
+    return f"{prefix}/person{person_id}/{measurement_type}"
+
+# Measurement types tracked per person, and the highest person ID the scale uses (1-8)
+_TYPE_IDX = {'weight': 0, 'body': 1}
+_MAX_PERSON_ID = 8
+_SLOTS = (_MAX_PERSON_ID + 1) * len(_TYPE_IDX)
+_EMPTY_SLOTS = (None,) * _SLOTS
+
+# MQTT clients shared by all plugin instances for the process lifetime,
+# keyed by (host, port, username, password)
+_CLIENTS = {}
+
+def _get_or_create_client(host, port, username, password):
+    """Return (client, created) for the broker, creating the client on first use."""
+    key = (host, port, username, password)
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client, False
+    
+    client = mqtt.Client()
+    if username and password:
+        client.username_pw_set(username, password)
+    _CLIENTS[key] = client
+    return client, True
+
+def _discard_client(host, port, username, password):
+    """Forget a shared client so the next plugin instance creates a new one."""
+    _CLIENTS.pop((host, port, username, password), None)
+
 class BS440mqtt(PluginBase):
     """Plugin to publish data to an MQTT broker."""
     
@@ -18,41 +71,37 @@ class BS440mqtt(PluginBase):
         self.mqtt_prefix = config.get('MQTT', 'prefix', fallback='medisana/bs440')
         self.mqtt_retain = config.getboolean('MQTT', 'retain', fallback=True)
         self.mqtt_qos = config.getint('MQTT', 'qos', fallback=0)
+        self.mqtt_per_type_topics = config.getboolean('MQTT', 'per_type_topics', fallback=True)
         
-        # Initialize MQTT client
-        self.client = mqtt.Client()
-        self.connected = False  # Track connection status
-        # Track most recent measurement per person per type: {(person_id, type): measurement}
-        self.most_recent = {}
-        if self.mqtt_username and self.mqtt_password:
-            self.client.username_pw_set(self.mqtt_username, self.mqtt_password)
-            self.logger.debug("MQTT credentials configured")
+        # Get the shared MQTT client for this broker
+        self.client, created = _get_or_create_client(self.mqtt_host, self.mqtt_port,
+                                                     self.mqtt_username, self.mqtt_password)
+        # Track most recent measurement per person per type, indexed by person_id * len(_TYPE_IDX) + type index
+        self.most_recent = list(_EMPTY_SLOTS)
         
         # Set up callbacks for connection status
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_publish = self.on_publish
         
+        if not created:
+            self.logger.debug(f"Reusing MQTT client for {self.mqtt_host}:{self.mqtt_port}")
+            return
+        
         try:
             self.logger.info(f"Connecting to MQTT broker at {self.mqtt_host}:{self.mqtt_port}")
             self.logger.debug(f"MQTT configuration - Username: {'set' if self.mqtt_username else 'not set'}, "
                             f"Prefix: {self.mqtt_prefix}, QoS: {self.mqtt_qos}, Retain: {self.mqtt_retain}")
             self.client.connect(self.mqtt_host, self.mqtt_port, 60)
             self.client.loop_start()
-            self.logger.debug("MQTT client loop started, waiting for connection callback...")
-            # Give the connection a moment to establish
-            time.sleep(0.5)
-            if self.connected:
-                self.logger.debug("MQTT connection confirmed")
-            else:
-                self.logger.warning("MQTT connection not yet established, will retry on first publish")
+            self.logger.debug("MQTT client loop started, connection will be confirmed by callback")
         except Exception as e:
             self.logger.error(f"Failed to connect to MQTT broker: {str(e)}", exc_info=True)
-            self.connected = False
+            # Don't keep a client that never connected, the next instance will retry
+            _discard_client(self.mqtt_host, self.mqtt_port, self.mqtt_username, self.mqtt_password)
     
     def on_connect(self, client, userdata, flags, rc):
         """Callback for when the client connects to the broker."""
-        self.connected = (rc == 0)
         if rc == 0:
             self.logger.info(f"Successfully connected to MQTT broker at {self.mqtt_host}:{self.mqtt_port}")
             self.logger.debug(f"Connection flags: {flags}")
@@ -69,7 +118,6 @@ class BS440mqtt(PluginBase):
     
     def on_disconnect(self, client, userdata, rc):
         """Callback for when the client disconnects from the broker."""
-        self.connected = False
         if rc != 0:
             self.logger.warning(f"Unexpected disconnection from MQTT broker (result code: {rc})")
         else:
@@ -77,15 +125,7 @@ class BS440mqtt(PluginBase):
     
     def on_publish(self, client, userdata, mid):
         """Callback for when a message is published."""
-        self.logger.debug(f"on_publish callback received for message ID {mid}")
-    
-    def __del__(self):
-        """Clean up MQTT connection on object destruction."""
-        try:
-            self.client.loop_stop()
-            self.client.disconnect()
-        except:
-            pass
+        self.logger.debug("on_publish callback received for message ID %s", mid)
     
     def process_measurement(self, measurement):
         """Track a measurement to find the most recent per person per type.
@@ -93,7 +133,9 @@ class BS440mqtt(PluginBase):
         Since timestamps from the scale can be corrupted, we use the order of
         measurements instead - the last measurement received is the most recent.
         """
-        self.logger.debug(f"process_measurement called with: {measurement}")
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(f"process_measurement called with: {measurement}")
         
         if not measurement:
             self.logger.debug("Measurement is None or empty, skipping")
@@ -101,56 +143,71 @@ class BS440mqtt(PluginBase):
         
         # Skip person data
         if measurement.get('type') == 'person':
-            self.logger.debug(f"Skipping person data measurement: {measurement}")
+            if debug:
+                self.logger.debug(f"Skipping person data measurement: {measurement}")
             return
         
         person_id = measurement.get('person', 0)
         measurement_type = measurement.get('type', 'unknown')
-        key = (person_id, measurement_type)
+        type_idx = _TYPE_IDX.get(measurement_type)
+        if type_idx is None or not 0 <= person_id <= _MAX_PERSON_ID:
+            if debug:
+                self.logger.debug(f"Ignoring {measurement_type} measurement for person {person_id}")
+            return
         
         # Simply keep the last measurement we see for each person/type combination
         # Since measurements come in chronological order, the last one is the most recent
-        self.most_recent[key] = measurement
-        self.logger.debug(f"Tracking measurement for person {person_id}, type {measurement_type} (will be overwritten if newer measurement arrives)")
+        self.most_recent[person_id * len(_TYPE_IDX) + type_idx] = measurement
+        if debug:
+            self.logger.debug(f"Tracking measurement for person {person_id}, type {measurement_type} (will be overwritten if newer measurement arrives)")
     
     def _publish_measurement(self, measurement):
         """Internal method to publish a single measurement to MQTT."""
-        if not self.connected:
-            self.logger.warning(f"MQTT broker not connected, cannot publish measurement. Connection status: {self.connected}")
-            return False
-        
         person_id = measurement.get('person', 0)
         measurement_type = measurement.get('type', 'unknown')
         
         # Create topic based on measurement type and person
-        topic = f"{self.mqtt_prefix}/person{person_id}/{measurement_type}"
-        self.logger.debug(f"MQTT topic: {topic}")
+        topic = _topic_for(self.mqtt_prefix, person_id, measurement_type)
+        return self._publish(topic, measurement)
+    
+    def _publish_summary(self, person_id, measurements):
+        """Internal method to publish all measurements of a person as one message, keyed by type."""
+        topic = _topic_for(self.mqtt_prefix, person_id, 'summary')
+        summary = {m.get('type', 'unknown'): m for m in measurements}
+        return self._publish(topic, summary)
+    
+    def _publish(self, topic, data):
+        """Internal method to publish data as JSON to an MQTT topic."""
+        if not self.client.is_connected():
+            self.logger.warning("MQTT broker not connected, cannot publish measurement")
+            return False
         
-        # Convert timestamp to ISO format if present
-        measurement_copy = measurement.copy()  # Create a copy to avoid modifying the original
-        if 'timestamp' in measurement_copy and isinstance(measurement_copy['timestamp'], datetime):
-            measurement_copy['timestamp'] = measurement_copy['timestamp'].isoformat()
-            self.logger.debug(f"Converted timestamp to ISO format: {measurement_copy['timestamp']}")
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(f"MQTT topic: {topic}")
         
         # Convert to JSON and publish
         try:
-            payload = json.dumps(measurement_copy)
-            self.logger.debug(f"JSON payload created: {payload}")
+            payload = _dumps(data)
+            if debug:
+                self.logger.debug(f"JSON payload created: {payload.decode()}")
         except Exception as e:
-            self.logger.error(f"Failed to serialize measurement to JSON: {str(e)}", exc_info=True)
+            self.logger.error(f"Failed to serialize measurement to JSON: {str(e)}")
             return False
         
         try:
             self.logger.info(f"Publishing to MQTT topic: {topic}")
-            self.logger.debug(f"Publish parameters - QoS: {self.mqtt_qos}, Retain: {self.mqtt_retain}")
-            self.logger.debug(f"Payload (first 200 chars): {payload[:200]}")
+            if debug:
+                self.logger.debug(f"Publish parameters - QoS: {self.mqtt_qos}, Retain: {self.mqtt_retain}")
+                self.logger.debug(f"Payload (first 200 chars): {payload.decode()[:200]}")
             
             result = self.client.publish(topic, payload, qos=self.mqtt_qos, retain=self.mqtt_retain)
             
             # Log detailed publish result
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
                 self.logger.info(f"Successfully published to {topic} (Message ID: {result.mid})")
-                self.logger.debug(f"Publish result - rc: {result.rc}, mid: {result.mid}, is_published: {result.is_published()}")
+                if debug:
+                    self.logger.debug(f"Publish result - rc: {result.rc}, mid: {result.mid}, is_published: {result.is_published()}")
                 return True
             else:
                 error_messages = {
@@ -162,53 +219,53 @@ class BS440mqtt(PluginBase):
                 return False
                 
         except Exception as e:
-            self.logger.error(f"Exception while publishing to MQTT: {str(e)}", exc_info=True)
+            self.logger.error(f"Exception while publishing to MQTT: {str(e)}")
             return False
     
     def process_measurements(self, measurements):
         """Process multiple measurements and publish only the most recent per person per type for the person who just stepped on."""
-        # Reset tracking for this batch
-        self.most_recent = {}
+        # Reset tracking for this batch, reusing the existing list
+        self.most_recent[:] = _EMPTY_SLOTS
         current_person_id = None
         
-        # First pass: find the most recent "person" measurement to identify who just stepped on
-        # Since person measurements don't have timestamps, we use the last one in the list
-        # (measurements are received in order, so the last person measurement is the current one)
+        # Single pass: the last "person" measurement identifies who just stepped on. Since person
+        # measurements don't have timestamps, we rely on the order (measurements are received in
+        # order, so the last person measurement is the current one). Every other measurement is
+        # tracked in its person's slots, so the current person's are known once the pass ends.
         self.logger.info(f"Processing {len(measurements)} measurements to identify current person")
-        most_recent_person_measurement = None
-        
-        # Find the last person measurement (most recent)
-        for measurement in reversed(measurements):
+        for measurement in measurements:
             if measurement.get('type') == 'person':
-                most_recent_person_measurement = measurement
-                break
+                current_person_id = measurement.get('person')
+            else:
+                self.process_measurement(measurement)
         
-        if most_recent_person_measurement:
-            current_person_id = most_recent_person_measurement.get('person')
+        if current_person_id is not None:
             self.logger.info(f"Identified current person from scale: ID {current_person_id}")
         else:
             self.logger.warning("No person measurement found, cannot identify who stepped on the scale")
             return
         
-        # Second pass: track measurements only for the current person
-        self.logger.info(f"Finding most recent measurements for person {current_person_id}")
-        for measurement in measurements:
-            # Only process measurements for the current person
-            if measurement.get('person') == current_person_id:
-                self.process_measurement(measurement)
-        
-        # Third pass: publish only the most recent measurements for the current person
-        if not self.most_recent:
+        # Publish only the most recent measurements for the current person
+        current = []
+        if 0 <= current_person_id <= _MAX_PERSON_ID:
+            start = current_person_id * len(_TYPE_IDX)
+            current = [m for m in self.most_recent[start:start + len(_TYPE_IDX)] if m is not None]
+        if not current:
             self.logger.warning(f"No valid measurements found for person {current_person_id}")
             return
         
-        self.logger.info(f"Publishing {len(self.most_recent)} most recent measurement(s) for person {current_person_id} to MQTT")
-        published_count = 0
-        for key, measurement in self.most_recent.items():
-            person_id, measurement_type = key
-            if person_id == current_person_id:  # Double-check (should always be true)
-                self.logger.debug(f"Publishing most recent {measurement_type} for person {person_id}")
+        self.logger.info(f"Publishing {len(current)} most recent measurement(s) for person {current_person_id} to MQTT")
+        if self.mqtt_per_type_topics:
+            published_count = 0
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            for measurement in current:
+                if debug:
+                    self.logger.debug(f"Publishing most recent {measurement.get('type')} for person {current_person_id}")
                 if self._publish_measurement(measurement):
                     published_count += 1
+            
+            self.logger.info(f"Successfully published {published_count} out of {len(current)} most recent measurement(s) for person {current_person_id}")
         
-        self.logger.info(f"Successfully published {published_count} out of {len(self.most_recent)} most recent measurement(s) for person {current_person_id}") 
+        # One message with all of the person's most recent measurements
+        if self._publish_summary(current_person_id, current):
+            self.logger.info(f"Successfully published measurement summary for person {current_person_id}") 